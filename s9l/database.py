@@ -47,9 +47,13 @@ __all__ = [
     'Database',
 ]
 
+import atexit
+import base64
+import json
 import logging
 import sqlite3
 import threading
+import time
 import typing
 
 from s9l import config
@@ -89,18 +93,24 @@ class Database:
             _LOGGER.debug('connect \'%s?mode=%s\'', uri, mode)
             self.__uri: str = uri
             self.__connection: sqlite3.Connection = sqlite3.connect(
-                f'file://{self.__uri}?mode={mode}', uri=True)
+                f'file://{self.__uri}?mode={mode}',
+                uri=True,
+                check_same_thread=False)
+            for name, narg, function in [('s9l_contains', 2, _contains),
+                                         ('s9l_at', 2, _at),
+                                         ('s9l_len', 1, _len)]:
+                self.__connection.create_function(name,
+                                                  narg,
+                                                  function,
+                                                  deterministic=True)
             self.__lock: threading.Lock = threading.Lock()
             self.__tables: typing.Dict[str, Database._Table] = {
-                identifier: Database._Table(self, identifier, columns)
-                for identifier, columns in [
-                    self.execute(f'PRAGMA table_info({k});',
-                                 post=lambda i: (k, [(j[1], _DataType(j[2]))
-                                                     for j in i]))
-                    for k in self.execute(
-                        'SELECT name FROM sqlite_master WHERE type = \'table\';',
-                        post=lambda i: [j[0] for j in i if j])
-                ]
+                identifier:
+                    Database._Table(self, identifier,
+                                    self.__reflect(identifier))
+                for identifier in self.execute(
+                    'SELECT name FROM sqlite_master WHERE type = \'table\';',
+                    post=lambda i: [j[0] for j in i if j])
             }
 
         def __del__(self) -> None:
@@ -109,7 +119,7 @@ class Database:
 
         def __getitem__(self,
                         identifier: str) -> typing.Optional[Database._Table]:
-            if identifier in self.__tables.keys():
+            if identifier in self.__tables:
                 return self.__tables[identifier]
             _LOGGER.warning('missing table \'%s\'', identifier)
             return None
@@ -120,11 +130,32 @@ class Database:
                                                   Database.Column]]) -> None:
             table = Database._Table(self, identifier, columns)
 
-            if identifier not in self.__tables.keys():
+            if identifier not in self.__tables:
                 table.create()
 
             self.__tables[identifier] = table
 
+        def __reflect(
+                self, identifier: str
+        ) -> typing.List[typing.Tuple[str, Database.Column]]:
+            columns = self.execute(f'PRAGMA table_info({identifier});')
+            unique = {
+                self.execute(f'PRAGMA index_info(\'{index[1]}\');',
+                             post=lambda i: i[0][2] if len(i) == 1 else None)
+                for index in self.execute(f'PRAGMA index_list({identifier});')
+                if index[2] and not index[4]
+            }
+            primary = [column[1] for column in columns if column[5]]
+            if len(primary) > 1:
+                _LOGGER.warning('ignore composite primary key of table \'%s\'',
+                                identifier)
+                primary = []
+
+            return [(column[1], PRIMARY_KEY(_DataType(column[2]))
+                     if column[1] in primary else UNIQUE(_DataType(column[2]))
+                     if column[1] in unique else _DataType(column[2]))
+                    for column in columns]
+
         @property
         def uri(self):
             return self.__uri
@@ -138,14 +169,15 @@ class Database:
         def execute(
             self,
             sql: str,
-            post: typing.Callable[[typing.List[str]],
-                                  __T] = lambda i: i) -> __T:
+            post: typing.Callable[[typing.List[str]], __T] = lambda i: i,
+            parameters: typing.Iterable[typing.Any] = ()
+        ) -> __T:
             with self.__lock:
                 _LOGGER.info(
                     'execute \'%s\'',
                     sql.replace(config.STX,
                                 '[STX]').replace(config.ETX, '[ETX]'))
-                return post(list(self.__connection.execute(sql)))
+                return post(list(self.__connection.execute(sql, parameters)))
 
         def commit(self, sql: str) -> None:
             with self.__lock:
@@ -156,6 +188,25 @@ class Database:
                 self.__connection.execute(sql)
                 self.__connection.commit()
 
+        def commit_many(
+            self, statements: typing.Iterable[typing.Tuple[
+                str, typing.Iterable[typing.Dict[str, typing.Any]]]]
+        ) -> None:
+            with self.__lock:
+                # the savepoint confines a rollback to this batch, other
+                # pending statements on the connection are kept
+                self.__connection.execute('SAVEPOINT commit_many;')
+                try:
+                    for sql, parameters in statements:
+                        _LOGGER.info('execute many \'%s\'', sql)
+                        self.__connection.executemany(sql, parameters)
+                except BaseException:
+                    self.__connection.execute('ROLLBACK TO commit_many;')
+                    self.__connection.execute('RELEASE commit_many;')
+                    raise
+                self.__connection.execute('RELEASE commit_many;')
+                self.__connection.commit()
+
     class _Table:
 
         IGNORED = {'modified'}
@@ -167,17 +218,66 @@ class Database:
             self.__database: Database._Database = database
             self.__identifier: str = identifier
             self.__columns: typing.List[typing.Tuple[str, Database.Column]] = [
-                column for column in columns if identifier not in self.IGNORED
+                column for column in columns if column[0] not in self.IGNORED
             ]
+            self.__writer: typing.Optional[Database._Table._Writer] = None
+            self.__modified: bool = False
 
         @property
         def identifier(self) -> str:
             return self.__identifier
 
+        @property
+        def key(self) -> typing.Optional[str]:
+            for column in self.__columns:
+                if column[1].primary:
+                    return column[0]
+            for column in self.__columns:
+                if column[1].unique:
+                    return column[0]
+            return None
+
         def __repr__(self) -> str:
             csv = ', '.join([column[0] for column in self.__columns])
             return f'Table(identifier: \'{self.__identifier}\', columns: [{csv}])'
 
+        def __encode(
+            self,
+            values: typing.Dict[str,
+                                typing.Any]) -> typing.Dict[str, typing.Any]:
+            for column in values.keys() - {
+                    column[0] for column in self.__columns
+            }:
+                _LOGGER.warning('missing column \'%s\'', column)
+
+            return {
+                column[0]: column[1].encode(values[column[0]])
+                for column in self.__columns
+                if column[0] in values.keys()
+            }
+
+        def __conflict(self, conflict: typing.Optional[str]) -> str:
+            conflict = conflict or self.key
+            if conflict not in {column[0] for column in self.__columns}:
+                _LOGGER.critical('missing conflict target for table \'%s\'',
+                                 self.__identifier)
+                raise ValueError()
+            return conflict
+
+        @staticmethod
+        def __group(
+            rows: typing.Iterable[typing.Dict[str, typing.Any]]
+        ) -> typing.List[typing.Tuple[typing.Tuple[
+                str, ...], typing.List[typing.Dict[str, typing.Any]]]]:
+            # only consecutive rows are grouped to keep the input order
+            groups = []
+            for row in rows:
+                if groups and groups[-1][0] == tuple(row.keys()):
+                    groups[-1][1].append(row)
+                else:
+                    groups.append((tuple(row.keys()), [row]))
+            return groups
+
         def create(self) -> None:
             csv = ', '.join([
                 f'{column[0]} {column[1].typename}' for column in self.__columns
@@ -185,6 +285,14 @@ class Database:
             self.__database.commit(
                 f'CREATE TABLE IF NOT EXISTS {self.__identifier}({csv}, modified DATETIME);'
             )
+            self.index('modified')
+
+        def index(self, column: str) -> None:
+            if column in self.__indexed():
+                return
+            self.__database.commit(
+                f'CREATE INDEX IF NOT EXISTS {self.__identifier}_{column} '
+                f'ON {self.__identifier}({column});')
 
         def insert(self,
                    values: typing.Dict[str, typing.Any],
@@ -197,22 +305,124 @@ class Database:
             #     _LOGGER.warning('duplicate entry %s', values)
             #     return
 
-            for column in values.keys() - {
-                    column[0] for column in self.__columns
-            }:
-                _LOGGER.warning('missing column \'%s\'', column)
             for column in {column[0] for column in self.__columns
                           } - values.keys():
                 _LOGGER.warning('missing value for column \'%s\'', column)
 
-            csv = ', '.join([
-                f'\'{column[1].encode(values[column[0]])}\''
-                if column[0] in values.keys() else 'NULL'
-                for column in self.__columns
+            self.__database.commit_many(self.__inserts([values], replace))
+
+        def update(self,
+                   values: typing.Dict[str, typing.Any],
+                   where: str = 'TRUE') -> None:
+            values = self.__encode(values)
+            if not values:
+                _LOGGER.warning('nothing to update')
+                return
+
+            csv = ', '.join([f'{column} = :{column}' for column in values])
+            self.__database.commit_many([
+                (f'UPDATE {self.__identifier} SET {csv}, '
+                 f'modified = CURRENT_TIMESTAMP WHERE {where};', [values])
             ])
-            self.__database.commit(
-                ('REPLACE' if replace else 'INSERT') +
-                f' INTO {self.__identifier} VALUES({csv}, CURRENT_TIMESTAMP);')
+
+        def update_many(self,
+                        values: typing.Iterable[typing.Dict[str, typing.Any]],
+                        key: typing.Optional[str] = None) -> None:
+            key = self.__conflict(key)
+
+            statements = []
+            for columns, rows in self.__group(
+                    self.__encode(row) for row in values):
+                if key not in columns:
+                    _LOGGER.error('missing value for column \'%s\'', key)
+                    continue
+                csv = ', '.join([
+                    f'{column} = :{column}' for column in columns
+                    if column != key
+                ])
+                if not csv:
+                    continue
+                statements.append(
+                    (f'UPDATE {self.__identifier} SET {csv}, '
+                     f'modified = CURRENT_TIMESTAMP WHERE {key} = :{key};',
+                     rows))
+            self.__database.commit_many(statements)
+
+        def upsert(self,
+                   values: typing.Dict[str, typing.Any],
+                   conflict: typing.Optional[str] = None) -> None:
+            self.upsert_many([values], conflict)
+
+        def upsert_many(self,
+                        values: typing.Iterable[typing.Dict[str, typing.Any]],
+                        conflict: typing.Optional[str] = None) -> None:
+            self.write([], values, conflict)
+
+        def buffered(self,
+                     size: int = 1000,
+                     interval: float = 1.0) -> Database._Table._Writer:
+            if not self.__writer or self.__writer.closed:
+                self.__writer = self._Writer(self, size, interval)
+            elif (size, interval) != (self.__writer.size,
+                                      self.__writer.interval):
+                _LOGGER.warning(
+                    'reuse writer for table \'%s\' with size %d and '
+                    'interval %.3fs', self.__identifier, self.__writer.size,
+                    self.__writer.interval)
+            return self.__writer
+
+        def write(self,
+                  inserts: typing.List[typing.Dict[str, typing.Any]],
+                  upserts: typing.List[typing.Dict[str, typing.Any]],
+                  conflict: typing.Optional[str] = None) -> None:
+            self.__database.commit_many(
+                self.__inserts(inserts) +
+                (self.__upserts(upserts, conflict) if upserts else []))
+
+        def __inserts(
+            self,
+            values: typing.Iterable[typing.Dict[str, typing.Any]],
+            replace: bool = True
+        ) -> typing.List[typing.Tuple[str, typing.List[typing.Dict[
+                str, typing.Any]]]]:
+            statements = []
+            for columns, rows in self.__group(
+                    self.__encode(row) for row in values):
+                csv = ', '.join(columns + ('modified',))
+                placeholders = ', '.join([f':{column}' for column in columns] +
+                                         ['CURRENT_TIMESTAMP'])
+                statements.append((('REPLACE' if replace else 'INSERT') +
+                                   f' INTO {self.__identifier}({csv}) '
+                                   f'VALUES({placeholders});', rows))
+            return statements
+
+        def __upserts(
+            self,
+            values: typing.Iterable[typing.Dict[str, typing.Any]],
+            conflict: typing.Optional[str] = None
+        ) -> typing.List[typing.Tuple[str, typing.List[typing.Dict[
+                str, typing.Any]]]]:
+            conflict = self.__conflict(conflict)
+
+            statements = []
+            for columns, rows in self.__group(
+                    self.__encode(row) for row in values):
+                if conflict not in columns:
+                    _LOGGER.critical('missing value for column \'%s\'',
+                                     conflict)
+                    raise ValueError()
+                csv = ', '.join(columns)
+                placeholders = ', '.join([f':{column}' for column in columns])
+                assignments = ', '.join([
+                    f'{column} = excluded.{column}' for column in columns
+                    if column != conflict
+                ] + ['modified = excluded.modified'])
+                statements.append(
+                    (f'INSERT INTO {self.__identifier}({csv}, modified) '
+                     f'VALUES({placeholders}, CURRENT_TIMESTAMP) '
+                     f'ON CONFLICT({conflict}) DO UPDATE SET {assignments};',
+                     rows))
+            return statements
 
         def select(self,
                    columns: typing.List[str] = None,
@@ -240,10 +450,386 @@ class Database:
                     if where else f'SELECT {csv} FROM {self.identifier};')
             ]
 
+        def paginate(
+            self,
+            order_by: typing.Optional[str] = None,
+            page_size: int = 100,
+            after: typing.Optional[str] = None,
+            descending: bool = False
+        ) -> typing.Tuple[typing.List[_Row], typing.Optional[str]]:
+            order_by = order_by or self.key or 'rowid'
+            if order_by != 'rowid' and order_by not in {
+                    column[0] for column in self.__columns
+            }:
+                _LOGGER.critical('missing column \'%s\'', order_by)
+                raise ValueError()
+            if order_by not in {'rowid', self.key} | self.__indexed():
+                _LOGGER.critical('missing index on column \'%s\'', order_by)
+                raise ValueError()
+
+            values, token = self.__seek(
+                self.identifier, [column[0] for column in self.__columns],
+                order_by,
+                page_size,
+                after,
+                descending=descending)
+
+            return [
+                self._Row({
+                    column[0]: column[1].decode(value[index])
+                    for index, column in enumerate(self.__columns)
+                })
+                for value in values
+            ], token if len(values) == page_size else None
+
+        def changes_since(
+            self,
+            watermark: typing.Optional[str] = None,
+            limit: int = 1000
+        ) -> typing.Tuple[typing.List[_Row], typing.Optional[str]]:
+            # tables created elsewhere get their index on first use only
+            if not self.__modified:
+                try:
+                    self.index('modified')
+                except sqlite3.OperationalError:
+                    _LOGGER.warning('missing index on column \'modified\'')
+                self.__modified = True
+
+            values, token = self.__seek(
+                self.identifier, [column[0] for column in self.__columns],
+                'modified',
+                limit,
+                watermark,
+                where='modified < datetime(\'now\')')
+
+            return [
+                self._Row({
+                    column[0]: column[1].decode(value[index])
+                    for index, column in enumerate(self.__columns)
+                })
+                for value in values
+            ], token or watermark
+
+        def track_deletes(self) -> None:
+            key = self.key or 'rowid'
+            self.__database.commit(
+                f'CREATE TABLE IF NOT EXISTS {self.identifier}_deleted'
+                f'(key, modified DATETIME);')
+            self.__database.commit(
+                f'CREATE INDEX IF NOT EXISTS {self.identifier}_deleted_modified '
+                f'ON {self.identifier}_deleted(modified);')
+            self.__database.commit(
+                f'CREATE TRIGGER IF NOT EXISTS {self.identifier}_deleted '
+                f'AFTER DELETE ON {self.identifier} BEGIN '
+                f'INSERT INTO {self.identifier}_deleted(key, modified) '
+                f'VALUES(OLD.{key}, CURRENT_TIMESTAMP); END;')
+
+        def deletes_since(
+            self,
+            watermark: typing.Optional[str] = None,
+            limit: int = 1000
+        ) -> typing.Tuple[typing.List[typing.Any], typing.Optional[str]]:
+            values, token = self.__seek(f'{self.identifier}_deleted', ['key'],
+                                        'modified',
+                                        limit,
+                                        watermark,
+                                        where='modified < datetime(\'now\')')
+
+            decode = {
+                column[0]: column[1].decode for column in self.__columns
+            }.get(self.key, lambda i: i)
+            return [decode(value[0]) for value in values], token or watermark
+
+        def __indexed(self) -> typing.Set[str]:
+            return {
+                self.__database.execute(f'PRAGMA index_info(\'{index[1]}\');',
+                                        post=lambda i: i[0][2] if i else None)
+                for index in self.__database.execute(
+                    f'PRAGMA index_list({self.identifier});')
+                if not index[4]
+            }
+
+        def __seek(
+            self,
+            identifier: str,
+            columns: typing.List[str],
+            order_by: str,
+            limit: int,
+            after: typing.Optional[str],
+            *,
+            descending: bool = False,
+            where: typing.Optional[str] = None
+        ) -> typing.Tuple[typing.List[typing.Any], typing.Optional[str]]:
+            if limit < 1:
+                _LOGGER.critical('invalid page size %d', limit)
+                raise ValueError()
+
+            segments = [([], [])]
+            if after:
+                segments = self.__segments(
+                    order_by, descending,
+                    *self.__untoken(after, identifier, order_by, descending))
+
+            direction = 'DESC' if descending else 'ASC'
+            values = []
+            for conditions, parameters in segments:
+                if len(values) >= limit:
+                    break
+                conditions = ([where] if where else []) + conditions
+                values += self.__database.execute(
+                    f'SELECT {", ".join(columns)}, {order_by}, rowid '
+                    f'FROM {identifier}'
+                    f'{" WHERE " if conditions else ""}'
+                    f'{" AND ".join([f"({i})" for i in conditions])} '
+                    f'ORDER BY {order_by} {direction}, rowid {direction} '
+                    f'LIMIT {int(limit) - len(values)};',
+                    parameters=parameters)
+
+            token = None
+            if values:
+                key = values[-1][-2]
+                if isinstance(key, bytes):
+                    key = {'blob': base64.b64encode(key).decode()}
+                token = base64.urlsafe_b64encode(
+                    json.dumps(
+                        [identifier, order_by, descending, key,
+                         values[-1][-1]]).encode()).decode()
+            return values, token
+
+        @staticmethod
+        def __segments(
+            order_by: str, descending: bool, key: typing.Any, rowid: int
+        ) -> typing.List[typing.Tuple[typing.List[str],
+                                      typing.List[typing.Any]]]:
+            # every segment is a single index range, NULLs sort first in
+            # ascending and last in descending order
+            if key is None and descending:
+                return [([f'{order_by} IS NULL', 'rowid < ?'], [rowid])]
+            if key is None:
+                return [([f'{order_by} IS NULL', 'rowid > ?'], [rowid]),
+                        ([f'{order_by} IS NOT NULL'], [])]
+            if descending:
+                return [([f'({order_by}, rowid) < (?, ?)'], [key, rowid]),
+                        ([f'{order_by} IS NULL'], [])]
+            return [([f'({order_by}, rowid) > (?, ?)'], [key, rowid])]
+
+        @staticmethod
+        def __untoken(after: str, identifier: str, order_by: str,
+                      descending: bool) -> typing.Tuple[typing.Any, int]:
+            try:
+                token = json.loads(base64.urlsafe_b64decode(after))
+                if (not isinstance(token, list) or len(token) != 5 or
+                        token[:3] != [identifier, order_by, descending] or
+                        not isinstance(token[4], int) or
+                        isinstance(token[3], list)):
+                    raise ValueError()
+                if isinstance(token[3], dict):
+                    if set(token[3]) != {'blob'}:
+                        raise ValueError()
+                    token[3] = base64.b64decode(token[3]['blob'], validate=True)
+            except (KeyError, TypeError, ValueError) as error:
+                _LOGGER.critical('invalid token \'%s\'', after)
+                raise ValueError() from error
+            return token[3], token[4]
+
         def delete(self, where: str = 'TRUE') -> None:
             self.__database.execute(
                 f'DELETE FROM {self.identifier} WHERE {where};')
 
+        class _Writer:
+
+            def __init__(self, table: Database._Table, size: int,
+                         interval: float) -> None:
+                self.__table: Database._Table = table
+                self.__size: int = size
+                self.__interval: float = interval
+                self.__key: typing.Optional[str] = table.key
+                self.__condition: threading.Condition = threading.Condition()
+                self.__keyed: typing.Dict[typing.Any, typing.Tuple[
+                    bool, typing.Dict[str, typing.Any]]] = {}
+                self.__unkeyed: typing.List[typing.Tuple[bool, typing.Dict[
+                    str, typing.Any]]] = []
+                self.__requested: int = 0
+                self.__completed: int = 0
+                self.__closed: bool = False
+                self.__stopped: bool = False
+                self.__flushes: int = 0
+                self.__rows: int = 0
+                self.__failures: int = 0
+                self.__latency: float = 0.0
+                self.__error: typing.Optional[Exception] = None
+                self.__pending: typing.Optional[Exception] = None
+                self.__thread: threading.Thread = threading.Thread(
+                    target=self.__run,
+                    name=f'writer-{table.identifier}',
+                    daemon=True)
+                self.__thread.start()
+                atexit.register(self.__exit)
+
+            @property
+            def size(self) -> int:
+                return self.__size
+
+            @property
+            def interval(self) -> float:
+                return self.__interval
+
+            @property
+            def closed(self) -> bool:
+                return self.__closed
+
+            @property
+            def depth(self) -> int:
+                with self.__condition:
+                    return len(self.__keyed) + len(self.__unkeyed)
+
+            @property
+            def metrics(self) -> typing.Dict[str, typing.Any]:
+                with self.__condition:
+                    return {
+                        'depth': len(self.__keyed) + len(self.__unkeyed),
+                        'flushes': self.__flushes,
+                        'rows': self.__rows,
+                        'failures': self.__failures,
+                        'latency': self.__latency,
+                        'error': repr(self.__error) if self.__error else None,
+                    }
+
+            def insert(self, values: typing.Dict[str, typing.Any]) -> None:
+                self.__enqueue(False, values)
+
+            def upsert(self, values: typing.Dict[str, typing.Any]) -> None:
+                self.__enqueue(True, values)
+
+            def flush(self) -> None:
+                with self.__condition:
+                    self.__requested += 1
+                    requested = self.__requested
+                    self.__condition.notify_all()
+                    self.__condition.wait_for(
+                        lambda: self.__completed >= requested or self.__stopped)
+                    if self.__completed < requested:
+                        _LOGGER.critical('writer for table \'%s\' is stopped',
+                                         self.__table.identifier)
+                        raise RuntimeError()
+                self.__raise()
+
+            def close(self) -> None:
+                atexit.unregister(self.__exit)
+                with self.__condition:
+                    self.__closed = True
+                    self.__condition.notify_all()
+                self.__thread.join()
+                self.__raise()
+
+            def __exit(self) -> None:
+                try:
+                    self.close()
+                # the interpreter is shutting down, there is no caller left
+                except Exception:  # pylint: disable=broad-exception-caught
+                    _LOGGER.exception('could not close writer for table \'%s\'',
+                                      self.__table.identifier)
+
+            def __raise(self) -> None:
+                with self.__condition:
+                    error, self.__pending = self.__pending, None
+                if error:
+                    raise error
+
+            def __enqueue(self, upsert: bool,
+                          values: typing.Dict[str, typing.Any]) -> None:
+                with self.__condition:
+                    if self.__closed:
+                        _LOGGER.critical('writer for table \'%s\' is closed',
+                                         self.__table.identifier)
+                        raise RuntimeError()
+
+                    if upsert and self.__key not in values:
+                        _LOGGER.critical('missing value for column \'%s\'',
+                                         self.__key)
+                        raise ValueError()
+
+                    if self.__key not in values:
+                        self.__unkeyed.append((upsert, dict(values)))
+                    elif upsert and values[self.__key] in self.__keyed:
+                        pending = self.__keyed[values[self.__key]]
+                        self.__keyed[values[self.__key]] = (pending[0], {
+                            **pending[1],
+                            **values
+                        })
+                    else:
+                        self.__keyed[values[self.__key]] = (upsert,
+                                                            dict(values))
+
+                    if len(self.__keyed) + len(self.__unkeyed) >= self.__size:
+                        self.__condition.notify_all()
+
+            def __run(self) -> None:
+                try:
+                    while True:
+                        with self.__condition:
+                            self.__condition.wait_for(
+                                lambda: self.__closed or self.__requested > self
+                                .__completed or len(self.__keyed) + len(
+                                    self.__unkeyed) >= self.__size,
+                                timeout=self.__interval)
+                            batch = list(self.__keyed.values()) + self.__unkeyed
+                            self.__keyed, self.__unkeyed = {}, []
+                            requested = self.__requested
+                            closed = self.__closed
+
+                        if batch:
+                            self.__write(batch)
+
+                        with self.__condition:
+                            self.__completed = requested
+                            self.__condition.notify_all()
+
+                        if closed:
+                            return
+                finally:
+                    with self.__condition:
+                        self.__closed = True
+                        self.__stopped = True
+                        self.__condition.notify_all()
+
+            def __write(
+                self, batch: typing.List[typing.Tuple[bool,
+                                                      typing.Dict[str,
+                                                                  typing.Any]]]
+            ) -> None:
+                start = time.perf_counter()
+                errors = []
+                try:
+                    self.__table.write(
+                        [values for upsert, values in batch if not upsert],
+                        [values for upsert, values in batch if upsert],
+                        self.__key)
+                # any failure must reach flush() instead of killing the thread
+                except Exception:  # pylint: disable=broad-exception-caught
+                    _LOGGER.exception(
+                        'could not flush %d rows into \'%s\', retry each row',
+                        len(batch), self.__table.identifier)
+                    for upsert, values in batch:
+                        try:
+                            self.__table.write([] if upsert else [values],
+                                               [values] if upsert else [],
+                                               self.__key)
+                        except Exception as error:  # pylint: disable=broad-exception-caught
+                            errors.append(error)
+                latency = time.perf_counter() - start
+                _LOGGER.debug('flush %d rows into \'%s\' in %.3fs', len(batch),
+                              self.__table.identifier, latency)
+
+                with self.__condition:
+                    self.__rows += len(batch) - len(errors)
+                    if errors:
+                        self.__failures += len(errors)
+                        self.__error = self.__pending = errors[-1]
+                    else:
+                        self.__flushes += 1
+                        self.__latency = latency
+
         class _Row:
 
             def __init__(self, values: typing.Dict['str', typing.Any]) -> None:
@@ -276,6 +862,14 @@ class _DataType:
     def typename(self):
         return self.__typename
 
+    @property
+    def primary(self) -> bool:
+        return False
+
+    @property
+    def unique(self) -> bool:
+        return False
+
     __T = typing.TypeVar('__T')
 
     @staticmethod
@@ -307,20 +901,7 @@ class _Array(_DataType):
         ])
 
     def decode(self, values: str) -> typing.List[str]:
-        inner = []
-        level = 0
-        for character in values:
-            if level > 0:
-                inner[-1] += character
-            else:
-                inner.append(character)
-
-            if character is config.STX:
-                level += 1
-            elif character is config.ETX:
-                level -= 1
-
-        return [self.__item.decode(value[1:-1]) for value in inner]
+        return [self.__item.decode(value) for value in _items(values)]
 
 
 ARRAY: typing.Type[_Array] = _Array
@@ -377,6 +958,10 @@ class _Unique(_Decorator):
     def typename(self) -> str:
         return f'{super().typename} UNIQUE'
 
+    @property
+    def unique(self) -> bool:
+        return True
+
 
 UNIQUE: typing.Type[_Unique] = _Unique
 
@@ -397,5 +982,49 @@ class _PrimaryKey(_NotNull):
     def typename(self) -> str:
         return f'{super().typename} PRIMARY KEY'
 
+    @property
+    def primary(self) -> bool:
+        return True
+
+    @property
+    def unique(self) -> bool:
+        return True
+
 
 PRIMARY_KEY: typing.Type[_PrimaryKey] = _PrimaryKey
+
+
+def _items(values: str) -> typing.Iterator[str]:
+    level = 0
+    start = 0
+    for index, character in enumerate(values):
+        if character == config.STX:
+            if level == 0:
+                start = index + 1
+            level += 1
+        elif character == config.ETX:
+            level -= 1
+            if level == 0:
+                yield values[start:index]
+
+
+def _contains(values: typing.Optional[str],
+              value: typing.Any) -> typing.Optional[bool]:
+    if not isinstance(values, str) or value is None:
+        return None
+    return any(item == str(value) for item in _items(values))
+
+
+def _at(values: typing.Optional[str], index: int) -> typing.Optional[str]:
+    if not isinstance(values, str) or not isinstance(index, int):
+        return None
+    for position, item in enumerate(_items(values)):
+        if position == index:
+            return item
+    return None
+
+
+def _len(values: typing.Optional[str]) -> typing.Optional[int]:
+    if not isinstance(values, str):
+        return None
+    return sum(1 for _ in _items(values))
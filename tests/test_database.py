@@ -33,6 +33,16 @@
 
 # pylint: disable=wildcard-import,unused-wildcard-import
 
+import logging
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+import pytest
+
 from s9l.config import *
 from s9l.database import *
 
@@ -54,3 +64,426 @@ def test_database() -> None:
 
     assert expected['content'] == actual[0].content
     assert expected['id'] == actual[0].id
+
+
+def test_upsert() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_upsert'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+        ('tags', ARRAY(TEXT)),
+    ]
+    assert database['test_upsert'].key == 'id'
+
+    database['test_upsert'].insert({'id': 1, 'name': 'first', 'tags': ['a']})
+    rowid = database.execute('SELECT rowid FROM test_upsert WHERE id = 1;')
+
+    database['test_upsert'].upsert({'id': 1, 'tags': ['b', 'c']})
+    database['test_upsert'].upsert_many([
+        {
+            'id': 2,
+            'name': 'second',
+            'tags': [],
+        },
+        {
+            'id': 3,
+            'name': 'third',
+            'tags': [],
+        },
+    ])
+
+    actual = database['test_upsert'].select(where='id = 1')
+    assert actual[0].name == 'first'
+    assert actual[0].tags == ['b', 'c']
+    assert rowid == database.execute(
+        'SELECT rowid FROM test_upsert WHERE id = 1;')
+    assert len(database['test_upsert'].select()) == 3
+
+
+def test_update() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_update'] = [
+        ('id', INTEGER),
+        ('name', UNIQUE(NOT_NULL(TEXT))),
+        ('count', INTEGER),
+    ]
+    assert database['test_update'].key == 'name'
+
+    database['test_update'].upsert_many([
+        {
+            'id': 1,
+            'name': 'first',
+            'count': 0,
+        },
+        {
+            'id': 2,
+            'name': 'second',
+            'count': 0,
+        },
+    ])
+    database['test_update'].update({'count': 42}, where='id = 1')
+    database['test_update'].update_many([
+        {
+            'name': 'second',
+            'count': 7,
+        },
+    ])
+
+    actual = {row.name: row.count for row in database['test_update'].select()}
+    assert actual == {'first': 42, 'second': 7}
+
+    database['test_update'].update_many([
+        {
+            'name': 'first',
+            'count': 1,
+        },
+        {
+            'name': 'first',
+            'count': 2,
+            'id': 1,
+        },
+        {
+            'name': 'first',
+            'count': 3,
+        },
+    ])
+    database['test_update'].upsert_many([
+        {
+            'name': 'third',
+            'id': 3,
+        },
+        {
+            'name': 'third',
+            'id': 4,
+            'count': 0,
+        },
+        {
+            'name': 'third',
+            'id': 5,
+        },
+    ])
+
+    actual = {row.name: row for row in database['test_update'].select()}
+    assert actual['first'].count == 3
+    assert actual['third'].id == 5
+
+    database['test_update'].delete(where='name = \'second\'')
+    with pytest.raises(sqlite3.IntegrityError):
+        database['test_update'].insert({
+            'id': 1,
+            'name': 'first'
+        },
+                                       replace=False)
+    assert not database['test_update'].select(where='name = \'second\'')
+
+
+def test_reflect(tmp_path) -> None:
+    database = Database(f'{tmp_path}/reflect.db')
+    database['test_reflect'] = [
+        ('id', INTEGER),
+        ('name', UNIQUE(TEXT)),
+        ('flag', BOOL),
+    ]
+    database.commit('CREATE TABLE test_composite'
+                    '(a, b, modified DATETIME, PRIMARY KEY(a, b));')
+    database.commit('CREATE TABLE test_legacy(id, modified DATETIME);')
+    database.commit('CREATE INDEX test_legacy_changes '
+                    'ON test_legacy(modified);')
+    database['test_reflect'].insert({'id': 1, 'name': 'first', 'flag': None})
+    database['test_reflect'].upsert({'id': 2, 'name': 'second', 'flag': None})
+
+    Database(f'{tmp_path}/other.db')
+    database = Database(f'{tmp_path}/reflect.db')
+    assert database['test_reflect'].key == 'name'
+    assert database['test_composite'].key is None
+
+    def indexes(identifier: str) -> typing.List[str]:
+        return database.execute(f'PRAGMA index_list({identifier});',
+                                post=lambda i: [j[1] for j in i])
+
+    assert 'test_composite_modified' not in indexes('test_composite')
+    database['test_composite'].changes_since()
+    assert 'test_composite_modified' in indexes('test_composite')
+    database['test_legacy'].changes_since()
+    assert indexes('test_legacy') == ['test_legacy_changes']
+
+    database['test_reflect'].upsert({'name': 'first', 'id': 42})
+    assert database['test_reflect'].select(where='name = \'first\'')[0].id == 42
+    assert database.execute(
+        'SELECT DISTINCT typeof(flag) FROM test_reflect;') == [('null',)]
+
+
+def test_paginate() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_paginate'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+        ('count', INTEGER),
+    ]
+    database.commit('CREATE INDEX test_paginate_name ON test_paginate(name);')
+    database['test_paginate'].upsert_many([{
+        'id': index,
+        'name': None if index % 2 else f'{index % 3}',
+        'count': index,
+    } for index in range(10)])
+
+    for order_by, descending in [('id', False), ('name', False),
+                                 ('name', True)]:
+        rows = database['test_paginate'].select()
+        expected = sorted(
+            [row for row in rows if row[order_by] is None],
+            key=lambda row: row.id) + sorted(
+                [row for row in rows if row[order_by] is not None],
+                key=lambda row: (row[order_by], row.id))
+        if descending:
+            expected.reverse()
+        actual, token = [], None
+        while True:
+            rows, token = database['test_paginate'].paginate(
+                order_by=order_by,
+                page_size=4,
+                after=token,
+                descending=descending)
+            actual += rows
+            if not token:
+                break
+
+        assert [row.id for row in actual] == [row.id for row in expected]
+
+    _, token = database['test_paginate'].paginate(order_by='name', page_size=1)
+    for order_by, after in [('count', None), ('id', token), ('name', 'token'),
+                            ('name', token[:-4])]:
+        with pytest.raises(ValueError):
+            database['test_paginate'].paginate(order_by=order_by, after=after)
+
+
+def test_paginate_plan(caplog) -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_paginate_plan'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+        ('data', BLOB),
+    ]
+    database.commit('CREATE INDEX test_paginate_plan_name '
+                    'ON test_paginate_plan(name);')
+    database.commit('CREATE INDEX test_paginate_plan_data '
+                    'ON test_paginate_plan(data);')
+    database['test_paginate_plan'].upsert_many([{
+        'id': index,
+        'name': None if index % 2 else f'{index}',
+        'data': bytes([index]),
+    } for index in range(10)])
+
+    for descending in [False, True]:
+        token = database['test_paginate_plan'].paginate(
+            order_by='name', page_size=4, descending=descending)[1]
+        caplog.clear()
+        with caplog.at_level(logging.INFO, logger='s9l.database'):
+            database['test_paginate_plan'].paginate(order_by='name',
+                                                    page_size=4,
+                                                    after=token,
+                                                    descending=descending)
+        assert caplog.records
+        for sql in [
+                record.getMessage()[len('execute \''):-1]
+                for record in caplog.records
+        ]:
+            plan = database.execute(f'EXPLAIN QUERY PLAN {sql}',
+                                    parameters=[None] * sql.count('?'))
+            assert all(row[3].startswith('SEARCH') for row in plan)
+
+    actual, token = [], None
+    while True:
+        rows, token = database['test_paginate_plan'].paginate(order_by='data',
+                                                              page_size=3,
+                                                              after=token)
+        actual += [row.id for row in rows]
+        if not token:
+            break
+    assert actual == list(range(10))
+
+
+def test_buffered() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_buffered'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+        ('count', INTEGER),
+    ]
+    writer = database['test_buffered'].buffered(size=1000, interval=60.0)
+    assert writer is database['test_buffered'].buffered()
+
+    threads = [
+        threading.Thread(target=lambda offset=offset: [
+            writer.insert({
+                'id': offset + index,
+                'name': f'{offset + index}',
+                'count': 0,
+            }) for index in range(10)
+        ]) for offset in range(0, 40, 10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.upsert({'id': 1, 'count': 1})
+    writer.upsert({'id': 1, 'count': 2})
+    assert writer.depth == 40
+
+    writer.flush()
+    assert writer.metrics['depth'] == 0
+    assert writer.metrics['flushes'] == 1
+    assert writer.metrics['rows'] == 40
+
+    actual = {row.id: row for row in database['test_buffered'].select()}
+    assert len(actual) == 40
+    assert actual[1].name == '1'
+    assert actual[1].count == 2
+
+    writer.upsert({'id': 42, 'name': '42', 'count': 0})
+    writer.close()
+    assert writer.closed
+    assert database['test_buffered'].select(where='id = 42')
+
+
+def test_buffered_failure() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_buffered_failure'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('count', NOT_NULL(INTEGER)),
+        ('pair', TUPLE(TEXT, TEXT)),
+    ]
+    writer = database['test_buffered_failure'].buffered(interval=60.0)
+
+    writer.insert({'id': 1, 'count': None, 'pair': ['a', 'b']})
+    writer.insert({'id': 2, 'count': 2, 'pair': ['a', 'b']})
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.flush()
+    assert [row.id for row in database['test_buffered_failure'].select()] == [2]
+    assert writer.metrics['flushes'] == 0
+    assert writer.metrics['rows'] == 1
+    assert writer.metrics['failures'] == 1
+    assert writer.metrics['error']
+
+    writer.insert({'id': 3, 'count': 3, 'pair': ['a']})
+    with pytest.raises(TypeError):
+        writer.flush()
+    assert not writer.closed
+
+    writer.insert({'id': 4, 'count': 4, 'pair': ['a', 'b']})
+    writer.close()
+    assert writer.metrics['flushes'] == 1
+    assert writer.metrics['failures'] == 2
+    with pytest.raises(RuntimeError):
+        writer.insert({'id': 5, 'count': 5, 'pair': ['a', 'b']})
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert database['test_buffered_failure'].buffered() is not writer
+    database['test_buffered_failure'].buffered().close()
+
+
+def test_buffered_exit(tmp_path, caplog) -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_buffered_exit'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+    ]
+    writer = database['test_buffered_exit'].buffered(size=10)
+    with pytest.raises(ValueError):
+        writer.upsert({'name': 'missing'})
+    with caplog.at_level(logging.WARNING, logger='s9l.database'):
+        assert database['test_buffered_exit'].buffered(size=20) is writer
+    assert 'reuse writer' in caplog.text
+    writer.close()
+    assert writer.metrics['rows'] == 0
+
+    script = '\n'.join([
+        'from s9l.database import *',
+        f'database = Database(\'{tmp_path}/exit.db\')',
+        'database[\'test\'] = [(\'id\', PRIMARY_KEY(INTEGER))]',
+        'database[\'test\'].buffered(interval=60.0).insert({\'id\': 1})',
+    ])
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=ROOT_PATH)
+    assert Database(f'{tmp_path}/exit.db')['test'].select()[0].id == 1
+
+
+def test_changes_since() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_changes'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('name', TEXT),
+    ]
+    assert database.execute(
+        'PRAGMA index_list(test_changes);',
+        post=lambda i: 'test_changes_modified' in [j[1] for j in i])
+    database['test_changes'].track_deletes()
+
+    database['test_changes'].upsert_many([{
+        'id': index,
+        'name': f'{index}',
+    } for index in range(5)])
+    rows, watermark = database['test_changes'].changes_since()
+    database['test_changes'].upsert({'id': 0, 'name': 'zero'})
+    time.sleep(1.1)
+
+    actual = {row.id: row.name for row in rows}
+    while True:
+        rows, watermark = database['test_changes'].changes_since(watermark,
+                                                                 limit=2)
+        if not rows:
+            break
+        actual.update({row.id: row.name for row in rows})
+    assert actual == {0: 'zero', 1: '1', 2: '2', 3: '3', 4: '4'}
+
+    database['test_changes'].delete(where='id < 2')
+    time.sleep(1.1)
+    keys, watermark = database['test_changes'].deletes_since()
+    assert keys == [0, 1]
+    keys, _ = database['test_changes'].deletes_since(watermark)
+    assert not keys
+
+    database['test_keyless'] = [('name', TEXT)]
+    database['test_keyless'].track_deletes()
+    for name in ['first', 'second']:
+        database['test_keyless'].insert({'name': name})
+        database['test_keyless'].delete()
+    time.sleep(1.1)
+    keys, watermark = database['test_keyless'].deletes_since(limit=1)
+    assert keys == [1]
+    keys, watermark = database['test_keyless'].deletes_since(watermark)
+    assert keys == [1]
+
+
+def test_functions() -> None:
+    database = Database(DATABASE_PATH, mode='memory')
+    database['test_functions'] = [
+        ('id', PRIMARY_KEY(INTEGER)),
+        ('tags', ARRAY(TEXT)),
+        ('pair', TUPLE(TEXT, ARRAY(TEXT))),
+    ]
+    database['test_functions'].upsert_many([
+        {
+            'id': 1,
+            'tags': ['a', 'b'],
+            'pair': ['x', ['1', '2']],
+        },
+        {
+            'id': 2,
+            'tags': ['b', 'c', 'd'],
+            'pair': ['y', []],
+        },
+    ])
+    database.commit('CREATE INDEX test_functions_tags '
+                    'ON test_functions(s9l_len(tags));')
+
+    def select(where: str) -> typing.List[int]:
+        return [
+            row.id for row in database['test_functions'].select(where=where)
+        ]
+
+    assert select('s9l_contains(tags, \'b\')') == [1, 2]
+    assert select('s9l_contains(tags, \'a\')') == [1]
+    assert select('s9l_len(tags) = 3') == [2]
+    assert select('s9l_at(pair, 0) = \'y\'') == [2]
+    assert select('s9l_contains(s9l_at(pair, 1), \'2\')') == [1]
+    assert select('s9l_at(tags, 5) IS NULL') == [1, 2]